@@ -1,5 +1,8 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import datetime
+import functools
 from pathlib import Path
 from urllib.parse import urlparse
 import re
@@ -7,28 +10,51 @@ import sys
 import warnings
 
 import icalendar
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import pandas as pd
 
 
-ALL_VARIANTS = set(('shogi', 'xiangqi', 'janggi', 'makruk'))
+ALL_VARIANTS = frozenset(('shogi', 'xiangqi', 'janggi', 'makruk'))
 FESA_URL = 'https://fesashogi.eu/calendar/'
 DXB_URL = 'http://chinaschach.de/blog/events/list/?ical=1'
 FFS_URL = 'https://shogi.fr/events/liste/?ical=1'
 SNK_URL = 'https://shogi.es/calendario/lista/?ical=1'
 TOURNEY_MOMENTUMS_URL = 'https://tourney-momentums.eu/tournaments/category/english/list/?ical=1'
+MAX_RETRIES = 3
+RETRY_DELAY = 1
+LOCATION_NOISE_PATTERNS = (
+    # street names
+    re.compile(r'[^, ][^,]* \d+'),
+    # zip codes
+    re.compile(r'\d{4,6}|\d+\-\d+'),
+    # lengthy names
+    re.compile(r'[^,]{30,}'),
+)
+
+# shared session to reuse connections across all calendar requests
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'chess-variants-tournaments/1.0'})
+for prefix in ('https://', 'http://'):
+    SESSION.mount(prefix, HTTPAdapter(
+        pool_maxsize=32,
+        max_retries=Retry(total=MAX_RETRIES, backoff_factor=RETRY_DELAY, status_forcelist=(429, 500, 502, 503, 504)),
+    ))
 
 
 def get_content(target, params=None):
-    response = requests.get(target, params=params)
-    response.raise_for_status()
-    return response.content
+    # stream so that error responses are rejected before their body is downloaded
+    with SESSION.get(target, params=params, stream=True) as response:
+        response.raise_for_status()
+        return response.content
 
 
+@functools.lru_cache(maxsize=2048)
 def get_variant(title, variants):
     assert ALL_VARIANTS.intersection(variants)
-    words = set(title.lower().split())
-    found = words.intersection(variants)
+    found = {word for word in title.lower().split() if word in variants}
     if len(found) == 1:
         return found.pop().capitalize()
     else:
@@ -40,24 +66,26 @@ def render_link(url):
 
 
 def get_ics_calendar(url, columns, variants):
-    tournaments = []
+    starts, ends, event_variants, locations, summaries, links = [], [], [], [], [], []
     ics = get_content(url)
     if ics:
         gcal = icalendar.Calendar.from_ical(ics)
+        default_link = render_link(url)
         for component in gcal.walk():
-            if component.name == "VEVENT":
-                tournament_url = component.get('url') or url
-                tournaments.append([
-                    component.decoded('dtstart').strftime('%Y-%m-%d'),
-                    component.decoded('dtend').strftime('%Y-%m-%d'),
-                    get_variant(component.get('summary'), variants),
-                    component.get('location'),
-                    component.get('summary'),
-                    render_link(tournament_url)
-                ])
+            if component.name != "VEVENT":
+                continue
+            summary = component.get('summary')
+            tournament_url = component.get('url')
+            # dates and datetimes both start with YYYY-MM-DD in ISO format
+            starts.append(component.decoded('dtstart').isoformat()[:10])
+            ends.append(component.decoded('dtend').isoformat()[:10])
+            event_variants.append(get_variant(summary, variants))
+            locations.append(component.get('location'))
+            summaries.append(summary)
+            links.append(render_link(tournament_url) if tournament_url else default_link)
     else:
         warnings.warn(f'{url} does not return events')
-    return pd.DataFrame(tournaments, columns=columns)
+    return pd.DataFrame(dict(zip(columns, (starts, ends, event_variants, locations, summaries, links))))
 
 
 def get_html_calendar(url, columns):
@@ -68,21 +96,20 @@ def get_html_calendar(url, columns):
     df = df_list[-1]
     df.columns = ['Date', 'Event', 'Place', 'Info']
     # add year from section headers
-    year_rows = df[df.Date.str.contains('^\d+$', regex=True, na=False)]
-    years = tuple((row['Date'], index) for index, row in year_rows.iterrows())
-    df['Year'] = years[0][0]
-    for year, i in years:
-        df.loc[i:, 'Year'] = year
-    df = df.drop(year_rows.index, axis=0)
+    is_year = df.Date.str.contains(r'^\d+$', regex=True, na=False)
+    df['Year'] = df.Date.where(is_year).ffill().bfill()
+    df = df[~is_year]
     # reformat date
     df = df[df['Date'] != 'Date']
     df = df[df['Date'].notna()]
     df[['Start', 'End']] = df['Date'].str.split('-', expand=True)
     df['End'] = df.End.combine_first(df.Start)
-    def reformat_date(row, col):
-        return datetime.datetime.strptime(row[col].strip(), '%d %b').replace(year=int(row['Year'])).strftime('%Y-%m-%d')
-    df['Start'] = df.apply(lambda r: reformat_date(r, 'Start'), axis=1)
-    df['End'] = df.apply(lambda r: reformat_date(r, 'End'), axis=1)
+    # parse start and end dates in a single pass
+    days = pd.concat([df['Start'], df['End']]).str.strip()
+    years = pd.concat([df['Year'], df['Year']]).astype(str)
+    dates = pd.to_datetime(days + ' ' + years, format='%d %b %Y').dt.strftime('%Y-%m-%d')
+    df['Start'] = dates.iloc[:len(df)].to_numpy()
+    df['End'] = dates.iloc[len(df):].to_numpy()
     # add additional info
     df['Source'] = render_link(url)
     df['Variant'] = 'Shogi'
@@ -91,15 +118,23 @@ def get_html_calendar(url, columns):
     return df
 
 
+def dedupe_location(location):
+    return ", ".join(dict.fromkeys(s.strip() for s in location.split(',') if s.strip()))
+
+
 def prettify_location(locations):
-    # street names
-    locations.replace(to_replace='[^, ][^,]* \d+', value='', regex=True, inplace=True)
-    # strip zip code from city
-    locations.replace(to_replace=r'\d{4,6}|\d+\-\d+', value=r'', regex=True, inplace=True)
-    # lengthy names
-    locations.replace(to_replace='[^,]{30,}', value='', regex=True, inplace=True)
+    locations = locations.astype('string').fillna('-')
+    for pattern in LOCATION_NOISE_PATTERNS:
+        locations = locations.str.replace(pattern, '', regex=True)
     # clean up by removing redundance and consolidating whitespacing
-    return locations.apply(lambda x: ", ".join(dict.fromkeys(s.strip() for s in str(x or '-').split(',') if s.strip())))
+    locations = locations.replace('', '-')
+    return pd.Series(np.frompyfunc(dedupe_location, 1, 1)(locations.to_numpy()), index=locations.index)
+
+
+def write_tsv(df, f):
+    writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+    writer.writerow(df.columns)
+    writer.writerows(df.fillna('').itertuples(index=False, name=None))
 
 
 if __name__ == '__main__':
@@ -110,27 +145,35 @@ if __name__ == '__main__':
     args = parser.parse_args()
     tsv_path = str((Path(__file__).absolute().parent.parent / '_data' / 'tournaments.tsv').resolve())
     current = pd.read_csv(tsv_path, sep='\t', header=0)
-    calendars = [
-        current
-    ]
+    today = datetime.datetime.today().strftime('%Y-%m-%d')
+    calendars = [current]
     if not args.offline:
-        calendars.extend([
-            get_ics_calendar(TOURNEY_MOMENTUMS_URL, current.columns, ('shogi', 'xiangqi', 'janggi', 'makruk')),
-            get_ics_calendar(DXB_URL, current.columns, ('xiangqi',)),
-            get_ics_calendar(FFS_URL, current.columns, ('shogi',)),
-            get_ics_calendar(SNK_URL, current.columns, ('shogi',)),
-            #get_html_calendar(FESA_URL, current.columns),
-        ])
-    merged = pd.concat(calendars)
+        jobs = [
+            (get_ics_calendar, TOURNEY_MOMENTUMS_URL, current.columns, ('shogi', 'xiangqi', 'janggi', 'makruk')),
+            (get_ics_calendar, DXB_URL, current.columns, ('xiangqi',)),
+            (get_ics_calendar, FFS_URL, current.columns, ('shogi',)),
+            (get_ics_calendar, SNK_URL, current.columns, ('shogi',)),
+            #(get_html_calendar, FESA_URL, current.columns),
+        ]
+        # fetch concurrently, but keep the source order for deduplication
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(fn, *fn_args) for fn, *fn_args in jobs]
+            calendars.extend(future.result() for future in futures)
+    merged = pd.concat(calendars, ignore_index=True)
     # try to remove street names, zip codes, and redundancy in location
     merged['location'] = prettify_location(merged['location'])
     # filter past and duplicate events
     if not args.unfiltered:
-        merged = merged[merged['end-date'] >= datetime.datetime.today().strftime('%Y-%m-%d')]
-        merged.drop_duplicates(subset=('start-date', 'variant', 'tournament'), keep='last', inplace=True)
+        merged = merged[merged['end-date'] >= today]
+        merged = merged.drop_duplicates(subset=('start-date', 'variant', 'tournament'), keep='last')
         # do some more fuzzy matching
-        merged['location2'] = merged['location'].apply(lambda s: re.match(r'^\w*', s).group())
-        merged.drop_duplicates(subset=('start-date', 'end-date', 'variant', 'location2'), keep='last', inplace=True)
-        merged = merged.drop(columns=['location2'])
+        fuzzy_keys = merged[['start-date', 'end-date', 'variant']].assign(
+            location2=merged['location'].str.extract(r'^(\w*)', expand=False))
+        merged = merged[~fuzzy_keys.duplicated(keep='last')]
     merged = merged.sort_values(by=['start-date', 'end-date', 'variant', 'location', 'tournament'])
-    merged.to_csv(sys.stdout if args.dry_run else tsv_path, sep='\t', index=False)
+    if args.dry_run:
+        write_tsv(merged, sys.stdout)
+    else:
+        with open(tsv_path, 'w', newline='', encoding='utf-8') as f:
+            write_tsv(merged, f)
+    SESSION.close()